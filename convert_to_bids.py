@@ -17,9 +17,40 @@ Author: Julien Cohen-Adad
 
 
 import argparse
-import os
 import gzip
+import io
+import os
+import re
 import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import redirect_stdout
+
+try:
+    # ISA-L provides a much faster (SIMD-accelerated) implementation of gzip compression
+    from isal import igzip
+except ImportError:
+    igzip = None
+
+# Compression level of the NIfTI files: the highest level of each implementation. ISA-L's highest level (3) produces
+# slightly larger files than gzip's (9), but compresses much faster.
+GZIP_COMPRESSLEVEL = 9
+ISAL_COMPRESSLEVEL = 3
+
+# Directory name patterns of healthy controls (e.g. 2023_10_02_DEV2_206_01_ICEBERG_ME_Sujet10) and patients
+# (e.g. 2020_10_29_ICEBERG_BB_277_V1_M)
+RE_HEALTHY_CONTROL = re.compile(r"DEV2_([^_]+)_.*Sujet(.+)")
+RE_PATIENT = re.compile(r"ICEBERG_([^_]+)_([^_]+)")
+
+# Scan types, checked in order: (pattern in the input filename, BIDS suffix, BIDS subfolder)
+SCAN_TYPES = (
+    ("T2_SAG", "T2.nii.gz", "anat"),
+    ("DTI_64DIR", "chunk-{dwi_chunk_counter}_DWI.nii.gz", "dwi"),
+    ("T1_SAG_MT_FL3D", "mt-on_MTS.nii.gz", "anat"),
+    ("T1_SAG_FL3D", "mt-off_MTS.nii.gz", "anat"),
+    ("mp2rage_sag_p3_1mm_iso_T1", "T1map.nii.gz", "anat"),
+    ("mp2rage_sag_p3_1mm_iso_UNI", "UNIT1.nii.gz", "anat"),
+)
 
 
 def extract_patient_id(dirname):
@@ -34,70 +65,156 @@ def extract_patient_id(dirname):
     2023_10_20_DEV2_214_01_ICEBERG_ME_Sujet12 -> sub-DEV214Sujet12
 
     Args:
-        dirname (_type_): _description_
+        dirname (str): Name of the patient directory
 
     Returns:
-        _type_: _description_
+        str: BIDS patient ID, or None if the directory name does not match any known pattern
     """
     # Check if subject is healthy control or patient
-    if "DEV2" in dirname:
+    match = RE_HEALTHY_CONTROL.search(dirname)
+    if match:
         # Healthy control
-        patient_number = dirname.rsplit("DEV2_")[1].rsplit("_")[0]
-        patient_sujet_number = dirname.rsplit("Sujet")[1]
-        patient_id = f"sub-DEV{patient_number}Sujet{patient_sujet_number}"
-    else:
+        return f"sub-DEV{match[1]}Sujet{match[2]}"
+    match = RE_PATIENT.search(dirname)
+    if match:
         # Patient
-        patient_initials = dirname.split("ICEBERG_")[1].split("_")[0]
-        patient_number = dirname.split("ICEBERG_")[1].split("_")[1]
-        patient_id = f"sub-{patient_initials}{patient_number}"
-    return patient_id
+        return f"sub-{match[1]}{match[2]}"
+    return None
 
 
-def convert_mri_to_bids(path_in, path_out):
+def convert_mri_to_bids(path_in, path_out, jobs=None, force=False):
     """Converts the MRI data to BIDS format.
 
+    Patients are processed in parallel, one process per patient. The conversion log of each patient is printed as a
+    whole once the patient is done.
+
     Args:
         path_in (_type_): _description_
         path_out (_type_): _description_
+        jobs (int): Number of patients to convert in parallel. If None, use the default of ProcessPoolExecutor (number
+            of CPU cores).
+        force (bool): If True, overwrite output files even if they are up to date.
+    """
+    # Group the input directories by BIDS patient ID. Directories with the same ID (e.g. several visits of the same
+    # patient) write the same output files, so they are converted one after the other, in sorted order, by one job.
+    patient_dirs_by_id = {}
+    for patient_dir in sorted(os.listdir(path_in)):
+        if not os.path.isdir(os.path.join(path_in, patient_dir)):
+            continue
+        bids_patient_id = extract_patient_id(patient_dir)
+        if not bids_patient_id:
+            print(f"Could not determine BIDS patient ID for directory: {patient_dir}")
+            continue  # Skip directory if patient ID cannot be determined
+        patient_dirs_by_id.setdefault(bids_patient_id, []).append(patient_dir)
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(process_patient, patient_dirs, bids_patient_id, path_in, path_out, force)
+                   for bids_patient_id, patient_dirs in patient_dirs_by_id.items()]
+        for future in as_completed(futures):
+            # Re-raise any exception that occurred in the worker process
+            print(future.result(), end="")
+
+
+def process_patient(patient_dirs, bids_patient_id, path_in, path_out, force=False):
+    """Converts the MRI data of one patient to BIDS format.
+
+    Args:
+        patient_dirs (list): Names of the directories of the patient, relative to path_in. They are converted in this
+            order, so files of later directories overwrite those of earlier ones.
+        bids_patient_id (str): BIDS patient ID, as returned by extract_patient_id
+        path_in (str): Root directory of the MRI files
+        path_out (str): Output directory for BIDS-structured files
+        force (bool): If True, overwrite output files even if they are up to date.
+
+    Returns:
+        str: Conversion log of the patient. It is returned instead of printed, so that the logs of patients converted
+        in parallel do not get mixed up.
+    """
+    log = io.StringIO()
+    # Output files written so far for this patient, shared by all its directories
+    written_paths = set()
+    with redirect_stdout(log):
+        for patient_dir in patient_dirs:
+            try:
+                convert_patient_dir(patient_dir, bids_patient_id, path_in, path_out, force, written_paths)
+            except Exception as e:
+                raise RuntimeError(f"Could not convert {patient_dir}. Conversion log:\n{log.getvalue()}") from e
+    return log.getvalue()
+
+
+def convert_patient_dir(patient_dir, bids_patient_id, path_in, path_out, force=False, written_paths=None):
+    """Converts the MRI data of one patient directory to BIDS format, printing the converted files.
+
+    Args:
+        patient_dir (str): Name of the patient directory, relative to path_in
+        bids_patient_id (str): BIDS patient ID, as returned by extract_patient_id
+        path_in (str): Root directory of the MRI files
+        path_out (str): Output directory for BIDS-structured files
+        force (bool): If True, overwrite output files even if they are up to date.
+        written_paths (set): Output files already written in this run. Updated with the files written here.
+    """
+    patient_path = os.path.join(path_in, patient_dir)
+    print(f"\n{patient_dir} -> {bids_patient_id}")
+    print(f"============================================================================")
+
+    bids_path = os.path.join(path_out, bids_patient_id)
+
+    # Counters for DWI chunks
+    dwi_chunk_counter = 1
+
+    for files_by_stem in iter_files_by_stem(patient_path):
+        for entries in files_by_stem.values():
+            if ".nii" in entries:
+                filename = entries[".nii"].name
+                # Determine the type of scan and set the BIDS path
+                new_filename, bids_subfolder = determine_scan_type_and_bids_path(filename, bids_patient_id, dwi_chunk_counter)
+                if new_filename:
+                    # Handle NIfTI files
+                    zip_and_move_file(entries[".nii"].path, os.path.join(bids_path, bids_subfolder, new_filename), zip_file=True, force=force, written_paths=written_paths)
+
+                    # Handle associated JSON files
+                    if '.json' in entries:
+                        zip_and_move_file(entries['.json'].path, os.path.join(bids_path, bids_subfolder, new_filename.replace('.nii.gz', '.json')), force=force,
+                                          written_paths=written_paths)
+
+                    # Handle DWI additional files
+                    if 'DWI' in new_filename:
+                        for ext in ['.bval', '.bvec']:
+                            if ext in entries:
+                                zip_and_move_file(entries[ext].path, os.path.join(bids_path, bids_subfolder, new_filename.replace('.nii.gz', ext)), force=force,
+                                                  written_paths=written_paths)
+                        dwi_chunk_counter += 1
+                else:
+                    print(f"❌ {filename}")
+
+
+def iter_files_by_stem(path):
+    """Recursively walks a directory and groups the files of each directory by stem.
+
+    Each directory is scanned only once, so that the sidecar files (JSON, bval, bvec) associated with a NIfTI file can
+    be looked up directly instead of searching the whole file list. Stems and subdirectories are sorted by name, so that
+    files are always processed in the same order (the numbering of DWI chunks depends on it). Unreadable directories
+    raise an error instead of being silently skipped, so that scans are never missing from the output without notice.
+
+    Args:
+        path (str): Directory to walk
+
+    Yields:
+        dict: Files of one directory, as {stem: {extension: os.DirEntry}}, sorted by stem. Parent directories are
+        yielded first.
     """
-    for patient_dir in os.listdir(path_in):
-        patient_path = os.path.join(path_in, patient_dir)
-        if os.path.isdir(patient_path):
-            bids_patient_id = extract_patient_id(patient_dir)
-            print(f"\n{patient_dir} -> {bids_patient_id}")
-            print(f"============================================================================")
-            if not bids_patient_id:
-                print(f"Could not determine BIDS patient ID for directory: {patient_dir}")
-                continue  # Skip directory if patient ID cannot be determined
-            
-            bids_path = os.path.join(path_out, bids_patient_id)
-
-            # Counters for DWI chunks
-            dwi_chunk_counter = 1
-
-            for dirpath, _, filenames in os.walk(patient_path):
-                for filename in filenames:
-                    if filename.endswith(".nii"):
-                        # Determine the type of scan and set the BIDS path
-                        new_filename, bids_subfolder = determine_scan_type_and_bids_path(filename, bids_patient_id, dwi_chunk_counter)
-                        if new_filename:
-                            # Handle NIfTI files
-                            zip_and_move_file(os.path.join(dirpath, filename), os.path.join(bids_path, bids_subfolder, new_filename), zip_file=True)
-                            
-                            # Handle associated JSON files
-                            json_filename = filename.replace('.nii', '.json')
-                            if json_filename in filenames:
-                                zip_and_move_file(os.path.join(dirpath, json_filename), os.path.join(bids_path, bids_subfolder, new_filename.replace('.nii.gz', '.json')))
-                            
-                            # Handle DWI additional files
-                            if 'DWI' in new_filename:
-                                for ext in ['.bval', '.bvec']:
-                                    dwi_file = filename.replace('.nii', ext)
-                                    if dwi_file in filenames:
-                                        zip_and_move_file(os.path.join(dirpath, dwi_file), os.path.join(bids_path, bids_subfolder, new_filename.replace('.nii.gz', ext)))
-                                dwi_chunk_counter += 1
-                        else:
-                            print(f"❌ {filename}")
+    files_by_stem = {}
+    subdirs = []
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+            elif entry.is_file():
+                stem, ext = os.path.splitext(entry.name)
+                files_by_stem.setdefault(stem, {})[ext] = entry
+    yield dict(sorted(files_by_stem.items()))
+    for subdir in sorted(subdirs):
+        yield from iter_files_by_stem(subdir)
 
 
 def determine_scan_type_and_bids_path(filename, patient_id, dwi_chunk_counter):
@@ -111,53 +228,112 @@ def determine_scan_type_and_bids_path(filename, patient_id, dwi_chunk_counter):
     Returns:
         _type_: _description_
     """
-    if "T2_SAG" in filename:
-        return f"{patient_id}_T2.nii.gz", "anat"
-    elif "DTI_64DIR" in filename:
-        return f"{patient_id}_chunk-{dwi_chunk_counter}_DWI.nii.gz", "dwi"
-    elif "T1_SAG_MT_FL3D" in filename:
-        return f"{patient_id}_mt-on_MTS.nii.gz", "anat"
-    elif "T1_SAG_FL3D" in filename:
-        return f"{patient_id}_mt-off_MTS.nii.gz", "anat"
-    elif "mp2rage_sag_p3_1mm_iso_T1" in filename:
-        return f"{patient_id}_T1map.nii.gz", "anat"
-    elif "mp2rage_sag_p3_1mm_iso_UNI" in filename:
-        return f"{patient_id}_UNIT1.nii.gz", "anat"
+    for pattern, suffix, bids_subfolder in SCAN_TYPES:
+        if pattern in filename:
+            return f"{patient_id}_{suffix.format(dwi_chunk_counter=dwi_chunk_counter)}", bids_subfolder
     return None, None
 
 
-def zip_and_move_file(src_path, dest_path, zip_file=False):
+def zip_and_move_file(src_path, dest_path, zip_file=False, force=False, written_paths=None):
     """Zips and moves a file.
 
+    The file is skipped if the destination already exists from a previous run, is not empty and is newer than the
+    source, unless force is True. A destination already written in this run (listed in written_paths) is never
+    considered up to date: it is overwritten, so that the last input file mapping to it wins, as with force. The output is first written to a uniquely named temporary file in the destination directory, then moved in
+    place, so that an interrupted run never leaves a partial file that would be considered up to date, and concurrent
+    writers of the same destination do not clobber each other's temporary file.
+
     Args:
         src_path (_type_): _description_
         dest_path (_type_): _description_
         zip (_type_): _description_
+        force (bool): If True, overwrite the destination even if it is up to date.
+        written_paths (set): Output files already written in this run. dest_path is added to it once written.
     """
+    if written_paths is not None and dest_path in written_paths:
+        print(f"⚠️ {dest_path} was already written in this run, overwriting it with {src_path}")
+    elif not force and os.path.exists(dest_path):
+        dest_stat = os.stat(dest_path)
+        if dest_stat.st_size > 0 and dest_stat.st_mtime >= os.stat(src_path).st_mtime:
+            print(f"⏩ {dest_path} is up to date")
+            return
     # Create output directory if it does not exist
     dest_dir = os.path.dirname(dest_path)
     os.makedirs(dest_dir, exist_ok=True)
-    # Zip and move the NIfTI file
-    if zip_file:
-        with open(src_path, 'rb') as f_in, gzip.open(dest_path, 'wb') as f_out:
-            shutil.copyfileobj(f_in, f_out)
-    else:
-        shutil.copy(src_path, dest_path)
+    fd, tmp_path = tempfile.mkstemp(dir=dest_dir, prefix='.', suffix='.tmp')
+    try:
+        # The descriptor is owned by f_tmp right away, so that it is closed whatever fails below
+        with os.fdopen(fd, 'wb') as f_tmp:
+            # mkstemp creates the file with mode 0600: give it the permissions a regular open() would have
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmp_path, 0o666 & ~umask)
+            # Zip and move the NIfTI file
+            if zip_file:
+                # Unbuffered input: the 4 MiB copy buffer already batches the reads
+                with open(src_path, 'rb', buffering=0) as f_in, \
+                        open_gzip(f_tmp, os.path.basename(dest_path)) as f_out:
+                    shutil.copyfileobj(f_in, f_out, length=4 * 1024 * 1024)
+        if not zip_file:
+            # copyfile only copies the content (no permission bits) and uses sendfile() on Linux
+            shutil.copyfile(src_path, tmp_path)
+        os.replace(tmp_path, dest_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    if written_paths is not None:
+        written_paths.add(dest_path)
 
     print(f"✅ {src_path} -> {dest_path}")
 
 
-def main(path_in, path_out):
+def open_gzip(fileobj, filename):
+    """Opens a gzip stream for writing, using ISA-L if it is installed and the standard gzip module otherwise.
+
+    Args:
+        fileobj (file object): Binary file object the compressed data is written to
+        filename (str): Name of the gzip file. It is recorded in the gzip header, without its .gz extension
+
+    Returns:
+        file object: Binary file object that compresses the data written to it
+    """
+    if igzip is not None:
+        return igzip.IGzipFile(filename=filename, mode='wb', compresslevel=ISAL_COMPRESSLEVEL, fileobj=fileobj)
+    return gzip.GzipFile(filename=filename, mode='wb', compresslevel=GZIP_COMPRESSLEVEL, fileobj=fileobj)
+
+
+def positive_int(value):
+    """Argparse type for strictly positive integers.
+
+    Args:
+        value (str): Command-line value
+
+    Returns:
+        int: Parsed value
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"must be an integer, got '{value}'")
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be a positive integer, got {number}")
+    return number
+
+
+def main(path_in, path_out, jobs=None, force=False):
     """Main function to convert MRI files to BIDS format.
 
     Args:
         path_in (_type_): _description_
         path_out (_type_): _description_
+        jobs (int): Number of patients to convert in parallel. If None, use the default of ProcessPoolExecutor (number
+            of CPU cores).
+        force (bool): If True, overwrite output files even if they are up to date.
     """
     print(f"Convert data to BIDS format.\n\n"
           f"Input: {path_in}\n"
           f"Output: {path_out}") 
-    convert_mri_to_bids(path_in, path_out)
+    convert_mri_to_bids(path_in, path_out, jobs=jobs, force=force)
 
 
 if __name__ == "__main__":
@@ -168,7 +344,11 @@ if __name__ == "__main__":
            formatter_class=argparse.RawDescriptionHelpFormatter)
     parser.add_argument("path_in", help="Root directory of the MRI files")
     parser.add_argument("path_out", help="Output directory for BIDS-structured files")
+    parser.add_argument("-j", "--jobs", type=positive_int, default=None,
+                        help="Number of patients to convert in parallel (default: number of CPU cores)")
+    parser.add_argument("-f", "--force", action="store_true",
+                        help="Overwrite output files even if they are newer than the input files")
 
     args = parser.parse_args()
 
-    main(args.path_in, args.path_out)
+    main(args.path_in, args.path_out, jobs=args.jobs, force=args.force)